@@ -0,0 +1,23 @@
+import os
+import multiprocessing
+
+# Gunicorn settings for production (Procfile: gunicorn -c gunicorn_conf.py main:app)
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Multiple Uvicorn workers so slow Gemini calls and openpyxl work don't serialize requests.
+# cpu_count() reports host CPUs inside containers and each worker holds its own template
+# bytes and openpyxl work, so cap the default; set WEB_CONCURRENCY to override.
+MAX_DEFAULT_WORKERS = 4
+workers = int(os.getenv("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2 + 1, MAX_DEFAULT_WORKERS)))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Gemini can take minutes for long audio
+timeout = 300
+graceful_timeout = 30
+keepalive = 5
+
+# Load main.py once in the master so templates/config are shared with workers (copy-on-write)
+preload_app = True
+
+accesslog = "-"
+errorlog = "-"
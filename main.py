@@ -1,10 +1,15 @@
 import os
-import json
-import shutil
-import uuid
+import io
+import asyncio
+import orjson
+import time
+import hashlib
+import threading
+from contextlib import asynccontextmanager
+from zipfile import ZipFile, ZIP_DEFLATED
 from typing import Optional, Dict
 import secrets
-from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException, BackgroundTasks, Depends, status
+from fastapi import FastAPI, UploadFile, File, Form, Request, Response, HTTPException, BackgroundTasks, Depends, status
 from fastapi.responses import HTMLResponse, FileResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
@@ -12,10 +17,11 @@ from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import uvicorn
 from dotenv import load_dotenv
 import openpyxl
-import google.generativeai as old_genai # Keeping old for safety if needed, but primary is new
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
 from openpyxl.styles import Alignment
+from openpyxl.writer.excel import ExcelWriter
 import datetime
 
 load_dotenv()
@@ -29,6 +35,10 @@ if GENAI_API_KEY:
     except Exception as e:
         print(f"Failed to initialize GenAI Client: {e}")
 
+GEMINI_MODEL = "gemini-3-flash-preview"
+# Write the raw Gemini response to debug_last_response.json when set
+DEBUG_GEMINI = bool(os.getenv("DEBUG_GEMINI"))
+
 # Security Configuration
 APP_USERNAME = os.getenv("APP_USERNAME", "admin")
 APP_PASSWORD = os.getenv("APP_PASSWORD", "password")
@@ -66,7 +76,61 @@ def cleanup_files(file_paths: list[str]):
         except Exception as e:
             print(f"Error deleting file {path}: {e}")
 
-app = FastAPI()
+def purge_old_files(directory: str, max_age: float):
+    """Delete regular files in a directory (not recursive) last modified more than max_age seconds ago."""
+    cutoff = time.time() - max_age
+    try:
+        with os.scandir(directory) as entries:
+            expired = [entry.path for entry in entries if entry.is_file() and entry.stat().st_mtime < cutoff]
+    except FileNotFoundError:
+        return
+    cleanup_files(expired)
+
+def write_json_atomic(path: str, data):
+    """Write JSON via a temp file + rename so concurrent workers never read a half-written file."""
+    tmp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp_path, path)
+    except Exception:
+        cleanup_files([tmp_path])
+        raise
+
+# Upload Save Helper
+# 1 MiB copy buffer to cut syscalls on large audio (shutil defaults to 64 KiB on Linux)
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+def save_upload(file: UploadFile, file_path: str) -> str:
+    """Copy an uploaded file to disk and return the SHA-256 hex digest of its contents."""
+    # Hash while writing so the Gemini caches never have to re-read the file
+    h = hashlib.sha256()
+    with open(file_path, "wb") as f:
+        while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+            h.update(chunk)
+            f.write(chunk)
+    return h.hexdigest()
+
+# Periodic Cleanup
+async def purge_expired_files_periodically():
+    """Delete expired outputs (and Gemini cache entries) even when no requests arrive."""
+    while True:
+        await asyncio.sleep(OUTPUT_PURGE_INTERVAL)
+        try:
+            await asyncio.to_thread(purge_old_files, OUTPUT_DIR, OUTPUT_RETENTION_SECONDS)
+            await asyncio.to_thread(sweep_gemini_cache)
+        except Exception as e:
+            print(f"Error purging expired files: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    purge_task = asyncio.create_task(purge_expired_files_periodically())
+    try:
+        yield
+    finally:
+        purge_task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 # Setup templates
 templates = Jinja2Templates(directory="templates")
@@ -78,150 +142,253 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 TEMP_DIR = "temp"
 OUTPUT_DIR = "outputs"
 STATIC_DIR = "static"
+GEMINI_CACHE_DIR = "gemini_cache"
+GEMINI_FILES_DIR = os.path.join(GEMINI_CACHE_DIR, "files")
 os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(STATIC_DIR, exist_ok=True)
+os.makedirs(GEMINI_CACHE_DIR, exist_ok=True)
+os.makedirs(GEMINI_FILES_DIR, exist_ok=True)
+
+# How long a cached Gemini response is reused (seconds, default 7 days)
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", 7 * 24 * 3600))
+# Gemini deletes uploaded files after 48 hours, so upload records are useless past that
+GEMINI_FILES_TTL = min(GEMINI_CACHE_TTL, 48 * 3600)
+# Minimum seconds between sweeps of expired cache entries
+GEMINI_CACHE_SWEEP_INTERVAL = 3600
+# Seconds a generated file stays downloadable (by file age, so retries/resumes keep working)
+OUTPUT_RETENTION_SECONDS = int(os.getenv("OUTPUT_RETENTION_SECONDS", 900))
+# How often idle workers sweep expired outputs
+OUTPUT_PURGE_INTERVAL = min(OUTPUT_RETENTION_SECONDS, 300)
+# Max seconds to wait for an uploaded file to finish processing
+GEMINI_UPLOAD_TIMEOUT = 120
 
 # Load Configuration
-with open("mapping_config.json", "r", encoding="utf-8") as f:
-    TEMPLATE_CONFIG = json.load(f)
+with open("mapping_config.json", "rb") as f:
+    TEMPLATE_CONFIG = orjson.loads(f.read())
+
+def resolve_cell_mapping(config_mapping: Dict[str, str]) -> Dict[str, tuple[Optional[str], str]]:
+    """Split "SheetName!Cell" config values into (sheet_name, cell); plain cells get sheet None."""
+    resolved = {}
+    for label, config_value in config_mapping.items():
+        parts = config_value.split("!")
+        if len(parts) == 2:
+            resolved[label] = (parts[0], parts[1])
+        else:
+            resolved[label] = (None, config_value)
+    return resolved
+
+RESOLVED_MAPPINGS = {template_id: resolve_cell_mapping(info['mapping']) for template_id, info in TEMPLATE_CONFIG.items()}
+
+def resolve_template_path(filename: str) -> Optional[str]:
+    """Find a template file, falling back to the 'template/' directory."""
+    # The config says "template/filename.xlsx", so it depends on CWD.
+    if os.path.exists(filename):
+        return filename
+    # Just incase config just has filename
+    alt_path = os.path.join("template", os.path.basename(filename))
+    if os.path.exists(alt_path):
+        return alt_path
+    return None
+
+# /templates payload never changes at runtime, so serialize it once
+TEMPLATES_JSON = orjson.dumps(TEMPLATE_CONFIG)
+
+# Outputs (personal data) left over from a previous run
+purge_old_files(OUTPUT_DIR, OUTPUT_RETENTION_SECONDS)
+
+# Template Cache: read each template once so requests parse from memory, not disk
+TEMPLATE_BYTES: Dict[str, bytes] = {}
+for _template_id, _template_info in TEMPLATE_CONFIG.items():
+    _template_path = resolve_template_path(_template_info['filename'])
+    if _template_path:
+        with open(_template_path, "rb") as f:
+            TEMPLATE_BYTES[_template_id] = f.read()
+    else:
+        print(f"Template file not found: {_template_info['filename']}")
 
 # Helper: Read Interim Monitoring Data
 def read_excel_monitoring_data(excel_path: str) -> str:
     """Read interim monitoring data from an uploaded Excel file."""
     try:
-        wb = openpyxl.load_workbook(excel_path)
-        
-        # Try to find the interim sheet
-        sheet_name = "モニタリング(中間)"
-        if sheet_name not in wb.sheetnames:
-            # Fallback to first sheet if specific name not found
-            sheet_name = wb.sheetnames[0]
-        
-        ws = wb[sheet_name]
-        
-        # Extract key data based on known cell positions
+        # read_only streams the sheet XML instead of building the full cell/style graph
+        wb = openpyxl.load_workbook(excel_path, read_only=True, data_only=True, keep_links=False)
+        try:
+            # Try to find the interim sheet
+            sheet_name = "モニタリング(中間)"
+            if sheet_name not in wb.sheetnames:
+                # Fallback to first sheet if specific name not found
+                sheet_name = wb.sheetnames[0]
+
+            ws = wb[sheet_name]
+
+            # Single pass over the A1:M22 block that holds every field we need
+            rows = [row + (None,) * (13 - len(row)) for row in ws.iter_rows(min_row=1, max_row=22, max_col=13, values_only=True)]
+        finally:
+            wb.close()
+        # Pad in case the sheet ends before row 22
+        rows += [(None,) * 13] * (22 - len(rows))
+
+        def first_status(row: tuple) -> str:
+            # First filled column of E:G, else "未定"
+            return next((v for v in row[4:7] if v), "未定")
+
+        row2, row3, row6, row11, row16, row22 = rows[1], rows[2], rows[5], rows[10], rows[15], rows[21]
+
+        # Extract key data based on known cell positions (0-based columns: A=0 ... M=12)
         data_lines = []
-        data_lines.append(f"利用者氏名: {ws['C3'].value or ''}")
-        data_lines.append(f"利用者氏名_ふりがな: {ws['C2'].value or ''}")
-        data_lines.append(f"作成者: {ws['J2'].value or ''}")
-        data_lines.append(f"作成年月日: {ws['K3'].value or ''}{ws['L3'].value or ''}{ws['M3'].value or ''}")
-        
+        data_lines.append(f"利用者氏名: {row3[2] or ''}")  # C3
+        data_lines.append(f"利用者氏名_ふりがな: {row2[2] or ''}")  # C2
+        data_lines.append(f"作成者: {row2[9] or ''}")  # J2
+        data_lines.append(f"作成年月日: {row3[10] or ''}{row3[11] or ''}{row3[12] or ''}")  # K3:M3
+
         # Goal 1
-        data_lines.append(f"達成目標: {ws['B6'].value or ''}")
-        status1 = ws['E6'].value or ws['F6'].value or ws['G6'].value or "未定"
-        data_lines.append(f"達成状況: {status1}")
-        data_lines.append(f"未達成原因・分析1: {ws['H6'].value or ''}")
-        data_lines.append(f"今後の対応: {ws['L6'].value or ''}")
-        
+        data_lines.append(f"達成目標: {row6[1] or ''}")  # B6
+        data_lines.append(f"達成状況: {first_status(row6)}")  # E6:G6
+        data_lines.append(f"未達成原因・分析1: {row6[7] or ''}")  # H6
+        data_lines.append(f"今後の対応: {row6[11] or ''}")  # L6
+
         # Goal 2
-        data_lines.append(f"達成目標: {ws['B11'].value or ''}")
-        status2 = ws['E11'].value or ws['F11'].value or ws['G11'].value or "未定"
-        data_lines.append(f"達成状況: {status2}")
-        data_lines.append(f"未達成原因・分析2: {ws['H11'].value or ''}")
-        data_lines.append(f"今後の対応: {ws['L11'].value or ''}")
-        
+        data_lines.append(f"達成目標: {row11[1] or ''}")  # B11
+        data_lines.append(f"達成状況: {first_status(row11)}")  # E11:G11
+        data_lines.append(f"未達成原因・分析2: {row11[7] or ''}")  # H11
+        data_lines.append(f"今後の対応: {row11[11] or ''}")  # L11
+
         # Goal 3
-        data_lines.append(f"達成目標: {ws['B16'].value or ''}")
-        status3 = ws['E16'].value or ws['F16'].value or ws['G16'].value or "未定"
-        data_lines.append(f"達成状況: {status3}")
-        data_lines.append(f"未達成原因・分析3: {ws['H16'].value or ''}")
-        data_lines.append(f"今後の対応: {ws['L16'].value or ''}")
-        
+        data_lines.append(f"達成目標: {row16[1] or ''}")  # B16
+        data_lines.append(f"達成状況: {first_status(row16)}")  # E16:G16
+        data_lines.append(f"未達成原因・分析3: {row16[7] or ''}")  # H16
+        data_lines.append(f"今後の対応: {row16[11] or ''}")  # L16
+
         # Other notes
-        data_lines.append(f"その他の気づき: {ws['A22'].value or ''}")
-        
+        data_lines.append(f"その他の気づき: {row22[0] or ''}")  # A22
+
         return "\n".join(data_lines)
     except Exception as e:
         print(f"Error reading interim Excel: {e}")
         return ""
 
+# Helper: Cell Alignments
+# Alignment objects are immutable, so build each variant once and reuse it across cells
+_VERTICAL_ALIGNMENTS: Dict[tuple, Alignment] = {}
+_WRAP_ALIGNMENTS: Dict[tuple, Alignment] = {}
+
+def vertical_alignment(shrink_to_fit, indent) -> Alignment:
+    """Vertical (stacked) text alignment for short status values like "【達成】"."""
+    key = (shrink_to_fit, indent)
+    align = _VERTICAL_ALIGNMENTS.get(key)
+    if align is None:
+        align = _VERTICAL_ALIGNMENTS[key] = Alignment(
+            horizontal='center', # Center alignment looks best for vertical
+            vertical='center',
+            text_rotation=255,   # 255 = Vertical Text (Stacked)
+            wrap_text=True,      # Often good to keep on standard vertical cells
+            shrink_to_fit=shrink_to_fit,
+            indent=indent
+        )
+    return align
+
+def wrap_alignment(horizontal, vertical, indent) -> Alignment:
+    """Wrapping alignment for long content cells."""
+    key = (horizontal, vertical, indent)
+    align = _WRAP_ALIGNMENTS.get(key)
+    if align is None:
+        align = _WRAP_ALIGNMENTS[key] = Alignment(
+            horizontal=horizontal or 'left',
+            vertical=vertical or 'top',
+            wrap_text=True,  # Enable text wrapping
+            shrink_to_fit=False,  # Disable shrink to fit
+            indent=indent
+        )
+    return align
+
+# Helper: Save Workbook
+# zlib level 1 compresses several times faster than the default (6) at a slightly larger file size
+XLSX_COMPRESS_LEVEL = 1
+
+def save_workbook(wb: openpyxl.Workbook, output_path: str):
+    """Same as wb.save(), but with a faster zip compression level.
+
+    Mirrors openpyxl.writer.excel.save_workbook (openpyxl is pinned to 3.x in requirements.txt).
+    """
+    wb.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    archive = ZipFile(output_path, 'w', ZIP_DEFLATED, allowZip64=True, compresslevel=XLSX_COMPRESS_LEVEL)
+    try:
+        ExcelWriter(wb, archive).save()
+    except Exception:
+        # Never leave a half-written .xlsx where /download would serve it,
+        # even if closing the archive fails too (e.g. disk full)
+        try:
+            archive.close()
+        finally:
+            cleanup_files([output_path])
+        raise
+
 # Helper: Fill Excel
-def fill_excel(template_path: str, mapping: Dict[str, str], config_mapping: Dict[str, str], output_name: str = None) -> str:
+def fill_excel(template_id: str, mapping: Dict[str, str], output_name: str = None) -> str:
     """Fill the Excel template with data based on config mapping."""
-    wb = openpyxl.load_workbook(template_path)
+    wb = openpyxl.load_workbook(io.BytesIO(TEMPLATE_BYTES[template_id]), keep_links=False, keep_vba=False)
+    # Look sheets up by name once instead of rebuilding wb.sheetnames per label
+    sheets = {name: wb[name] for name in wb.sheetnames}
     
     # Select sheet (Default)
     default_sheet_name = mapping.pop("_sheet_name", None)
-    if default_sheet_name and default_sheet_name in wb.sheetnames:
-         default_sheet = wb[default_sheet_name]
+    if default_sheet_name and default_sheet_name in sheets:
+         default_sheet = sheets[default_sheet_name]
     else:
          default_sheet = wb.active
     
-    # Invert the config mapping to know which AI key goes to which Cell
-    # config_mapping is { "Label": "Cell" }
+    # RESOLVED_MAPPINGS is { "Label": (SheetName or None, "Cell") }, parsed at startup
     # AI returns { "Label": "Value" }
+    resolved_mapping = RESOLVED_MAPPINGS[template_id]
     
     for label, value in mapping.items():
-        if label in config_mapping:
-            config_value = config_mapping[label]
+        if label in resolved_mapping:
+            s_name, cell_coord = resolved_mapping[label]
             
             # Determine target sheet and cell
             target_sheet = default_sheet
-            cell_coord = config_value
-            
-            # Check if config_value has "SheetName!Cell" format
-            if "!" in config_value:
-                parts = config_value.split("!")
-                if len(parts) == 2:
-                    s_name, c_coord = parts
-                    if s_name in wb.sheetnames:
-                        target_sheet = wb[s_name]
-                        cell_coord = c_coord
+            if s_name is not None:
+                if s_name in sheets:
+                    target_sheet = sheets[s_name]
+                else:
+                    # Unknown sheet: keep the raw "SheetName!Cell" value as before
+                    cell_coord = f"{s_name}!{cell_coord}"
             
             try:
                 # Skip if value is None (preserves template content)
                 if value is None:
                     continue
 
-                target_sheet[cell_coord] = value
+                # Resolve the cell once; every further lookup re-parses the coordinate
+                cell = target_sheet[cell_coord]
+                cell.value = value
                 
                 # Check for Vertical Text requirement (Status fields starting with '【')
                 # If value starts with '【' and is short (e.g. "【達成】"), assume vertical alignment needed.
                 if isinstance(value, str) and value.startswith("【") and len(value) < 10:
-                    current_align = target_sheet[cell_coord].alignment
-                    new_align = Alignment(
-                        horizontal='center', # Center alignment looks best for vertical
-                        vertical='center',
-                        text_rotation=255,   # 255 = Vertical Text (Stacked)
-                        wrap_text=True,      # Often good to keep on standard vertical cells
-                        shrink_to_fit=current_align.shrink_to_fit,
-                        indent=current_align.indent
-                    )
-                    target_sheet[cell_coord].alignment = new_align
+                    current_align = cell.alignment
+                    cell.alignment = vertical_alignment(current_align.shrink_to_fit, current_align.indent)
                 
                 # Enable text wrapping for long content cells
                 elif isinstance(value, str) and len(value) > 50:
-                    current_align = target_sheet[cell_coord].alignment
-                    new_align = Alignment(
-                        horizontal=current_align.horizontal or 'left',
-                        vertical=current_align.vertical or 'top',
-                        wrap_text=True,  # Enable text wrapping
-                        shrink_to_fit=False,  # Disable shrink to fit
-                        indent=current_align.indent
-                    )
-                    target_sheet[cell_coord].alignment = new_align
+                    current_align = cell.alignment
+                    cell.alignment = wrap_alignment(current_align.horizontal, current_align.vertical, current_align.indent)
             except Exception as e:
                 print(f"Error writing to {cell_coord} ({label}): {e}")
             
     if output_name:
         output_filename = output_name
     else:
-        output_filename = f"processed_{uuid.uuid4().hex}.xlsx"
+        output_filename = f"processed_{time.time_ns():016x}.xlsx"
         
     output_path = os.path.join(OUTPUT_DIR, output_filename)
-    wb.save(output_path)
+    save_workbook(wb, output_path)
     return output_filename
 
-# Helper: Gemini Processing
-def call_gemini(template_info: dict, text_input: str = None, file_paths: list = [], interim_data: str = None) -> Dict[str, str]:
-    """
-    Call Gemini to map input data to Excel structure.
-    interim_data: Optional string containing interim monitoring data for final evaluation mode.
-    """
-    if not client:
-        raise HTTPException(status_code=500, detail="Gemini Client not initialized.")
-
+# Helper: Gemini Prompt
+def build_system_instruction(template_info: dict) -> str:
+    """Build the static system instruction for a template."""
     # Construct mappings description for the prompt - ONLY field names, NO cell addresses
     mapping_keys = "\n".join([f"- {key}" for key in template_info['mapping'].keys()])
 
@@ -236,7 +403,7 @@ def call_gemini(template_info: dict, text_input: str = None, file_paths: list =
         style_instruction = f"\n\n--- Writing Style & Formatting Rules ---\n{style_instruction}\n----------------------------------------\n"
 
     # Construct the prompt text
-    system_instruction = (
+    return (
         "You are an expert welfare record assistant specializing in Japanese disability welfare services (障害福祉サービス). "
         "Your task is to understand the provided audio/images/text and extract relevant information for official documentation.\n"
         f"{context_instruction}\n"
@@ -255,8 +422,313 @@ def call_gemini(template_info: dict, text_input: str = None, file_paths: list =
         "- If a piece of information is missing, leave the value as an empty string or null.\n"
         "- Do not include markdown formatting (like ```json), just the raw JSON string.\n"
     )
+
+# Helper: Gemini Context Cache
+# Lifetime of a Gemini explicit context cache; refreshed shortly before expiry
+GEMINI_CONTEXT_CACHE_TTL = 3600
+GEMINI_CONTEXT_CACHE_REFRESH_MARGIN = 600
+# Shared records so all workers reuse one cached content per template instead of each paying for its own
+CONTEXT_CACHE_DIR = os.path.join(GEMINI_CACHE_DIR, "contexts")
+os.makedirs(CONTEXT_CACHE_DIR, exist_ok=True)
+# A worker holding the creation lock longer than this is assumed to have died
+CONTEXT_CACHE_LOCK_TIMEOUT = 60
+# template_id -> (cached content name or None, expires_at)
+CONTEXT_CACHES: Dict[str, tuple[Optional[str], float]] = {}
+# One lock per template so concurrent requests in a worker don't each create a cache
+CONTEXT_CACHE_LOCKS: Dict[str, threading.Lock] = {template_id: threading.Lock() for template_id in TEMPLATE_CONFIG}
+
+def _context_cache_record_path(template_id: str) -> str:
+    return os.path.join(CONTEXT_CACHE_DIR, f"{template_id}.json")
+
+def _load_context_cache_record(template_id: str) -> Optional[dict]:
+    """Return the shared {name, expires_at, model, instruction_hash} record written by any worker."""
+    try:
+        with open(_context_cache_record_path(template_id), "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error reading context cache record for {template_id}: {e}")
+    return None
+
+def _delete_cached_content(cache_name: str):
+    """Delete a cached content on Gemini so it stops being billed (best effort)."""
+    try:
+        client.caches.delete(name=cache_name)
+        print(f"Deleted Gemini context cache: {cache_name}")
+    except Exception as e:
+        print(f"Error deleting Gemini context cache {cache_name}: {e}")
+
+def _acquire_creation_lock(lock_path: str) -> bool:
+    """Cross-worker lock: only one process creates a template's cache at a time."""
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock_path) > CONTEXT_CACHE_LOCK_TIMEOUT:
+                os.remove(lock_path)
+                return _acquire_creation_lock(lock_path)
+        except FileNotFoundError:
+            return _acquire_creation_lock(lock_path)
+        return False
+
+def get_context_cache(template_id: str, system_instruction: str) -> Optional[str]:
+    """Return a Gemini cached-content name holding the template's system instruction.
+
+    Creates (or refreshes) the cache on demand. Returns None when caching is
+    unavailable, e.g. the instruction is below the model's minimum token count,
+    or while another worker is creating it.
+    """
+    cache_name, expires_at = CONTEXT_CACHES.get(template_id, (None, 0.0))
+    if time.time() < expires_at - GEMINI_CONTEXT_CACHE_REFRESH_MARGIN:
+        return cache_name
+
+    with CONTEXT_CACHE_LOCKS[template_id]:
+        # Another request may have refreshed it while we waited
+        now = time.time()
+        cache_name, expires_at = CONTEXT_CACHES.get(template_id, (None, 0.0))
+        if now < expires_at - GEMINI_CONTEXT_CACHE_REFRESH_MARGIN:
+            return cache_name
+
+        instruction_hash = hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()
+        record = _load_context_cache_record(template_id)
+        if record and (record.get("model") != GEMINI_MODEL or record.get("instruction_hash") != instruction_hash):
+            # Template or model changed; the old cache can never be used again
+            if now < record.get("expires_at", 0.0):
+                _delete_cached_content(record["name"])
+            record = None
+        if record and now < record["expires_at"] - GEMINI_CONTEXT_CACHE_REFRESH_MARGIN:
+            CONTEXT_CACHES[template_id] = (record["name"], record["expires_at"])
+            return record["name"]
+
+        lock_path = f"{_context_cache_record_path(template_id)}.lock"
+        if not _acquire_creation_lock(lock_path):
+            # Another worker is creating/refreshing it; send this request inline
+            return None
+        try:
+            expires_at = now + GEMINI_CONTEXT_CACHE_TTL
+            cache_name = None
+            if record and now < record["expires_at"]:
+                # Extend the existing cache instead of creating a second billed copy
+                try:
+                    client.caches.update(name=record["name"], config=types.UpdateCachedContentConfig(ttl=f"{GEMINI_CONTEXT_CACHE_TTL}s"))
+                    cache_name = record["name"]
+                    print(f"Extended Gemini context cache for {template_id}: {cache_name}")
+                except Exception as e:
+                    print(f"Could not extend Gemini context cache {record['name']}: {e}")
+            if cache_name is None:
+                cached_content = client.caches.create(
+                    model=GEMINI_MODEL,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=system_instruction,
+                        ttl=f"{GEMINI_CONTEXT_CACHE_TTL}s",
+                    ),
+                )
+                cache_name = cached_content.name
+                print(f"Created Gemini context cache for {template_id}: {cache_name}")
+            write_json_atomic(_context_cache_record_path(template_id), {
+                "name": cache_name,
+                "expires_at": expires_at,
+                "model": GEMINI_MODEL,
+                "instruction_hash": instruction_hash,
+            })
+            CONTEXT_CACHES[template_id] = (cache_name, expires_at)
+            return cache_name
+        except Exception as e:
+            # Fall back to inline instructions and retry creation later
+            print(f"Gemini context cache unavailable for {template_id}: {e}")
+            CONTEXT_CACHES[template_id] = (None, now + GEMINI_CONTEXT_CACHE_REFRESH_MARGIN * 2)
+            return None
+        finally:
+            cleanup_files([lock_path])
+
+def invalidate_context_cache(template_id: str, cache_name: str):
+    """Drop a cached content Gemini rejected: delete it remotely, in this worker and in the shared record."""
+    with CONTEXT_CACHE_LOCKS[template_id]:
+        if CONTEXT_CACHES.get(template_id, (None, 0.0))[0] == cache_name:
+            CONTEXT_CACHES.pop(template_id, None)
+        record = _load_context_cache_record(template_id)
+        if record and record.get("name") == cache_name:
+            cleanup_files([_context_cache_record_path(template_id)])
+    _delete_cached_content(cache_name)
+
+def is_context_cache_error(e: Exception) -> bool:
+    """True only if Gemini's error names the cached content (missing/expired).
+
+    Other 400/404s (bad file URI, unsupported MIME type) and quota/server errors
+    are not retried, since that would just send a second billed request.
+    """
+    if not isinstance(e, genai_errors.ClientError) or e.code == 429:
+        return False
+    message = str(e).lower()
+    return "cachedcontent" in message or "cached content" in message
+
+# Helper: Gemini File Upload
+MIME_BY_EXT = {
+    ".mp3": "audio/mp3",
+    ".wav": "audio/wav",
+    ".m4a": "audio/mp4",
+    ".aac": "audio/aac",
+    ".flac": "audio/flac",
+    ".ogg": "audio/ogg",
+    ".wma": "audio/x-ms-wma",
+    ".jobt": "image/jpeg",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".heic": "image/heic",
+    ".heif": "image/heic",
+    ".mp4": "video/mp4",
+    ".mov": "video/quicktime",
+    ".webm": "video/webm",
+    ".pdf": "application/pdf",
+    ".txt": "text/plain",
+    ".csv": "text/csv",
+}
+
+def guess_mime_type(path: str) -> str:
+    """Guess the MIME type Gemini expects from a file extension."""
+    ext = os.path.splitext(path)[1].lower()
+    return MIME_BY_EXT.get(ext, "application/octet-stream")
+
+def load_uploaded_file(file_hash: str) -> Optional[types.File]:
+    """Return a previously uploaded Gemini file for this content hash if it is still active."""
+    record_path = os.path.join(GEMINI_FILES_DIR, f"{file_hash}.json")
+    try:
+        with open(record_path, "rb") as f:
+            record = orjson.loads(f.read())
+        uploaded = client.files.get(name=record["name"])
+        if uploaded.state == types.FileState.ACTIVE:
+            return uploaded
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # Gemini deletes uploads after 48 hours; treat as a miss
+        print(f"Uploaded file for {file_hash} unavailable: {e}")
+    cleanup_files([record_path])
+    return None
+
+def upload_file(path: str, file_hash: str, mime_type: str) -> types.File:
+    """Upload a file to the Gemini Files API and wait until it can be used."""
+    print(f"Uploading file: {path}")
+    with open(path, "rb") as f:
+        uploaded = client.files.upload(file=f, config=types.UploadFileConfig(mime_type=mime_type, display_name=file_hash))
+
+    # Video (and occasionally audio) is processed asynchronously
+    deadline = time.time() + GEMINI_UPLOAD_TIMEOUT
+    while uploaded.state == types.FileState.PROCESSING and time.time() < deadline:
+        time.sleep(1)
+        uploaded = client.files.get(name=uploaded.name)
+    if uploaded.state != types.FileState.ACTIVE:
+        raise RuntimeError(f"Uploaded file {uploaded.name} is not active (state: {uploaded.state})")
+
+    record_path = os.path.join(GEMINI_FILES_DIR, f"{file_hash}.json")
+    write_json_atomic(record_path, {"name": uploaded.name, "uri": uploaded.uri, "mime_type": mime_type})
+    sweep_gemini_cache()
+    return uploaded
+
+def build_file_part(path: str, file_hash: str) -> types.Part:
+    """Reference a file through the Files API, reusing earlier uploads of identical content."""
+    mime_type = guess_mime_type(path)
+    try:
+        uploaded = load_uploaded_file(file_hash)
+        if uploaded is None:
+            uploaded = upload_file(path, file_hash, mime_type)
+        else:
+            print(f"Reusing uploaded file {uploaded.name} for {path}")
+        return types.Part.from_uri(file_uri=uploaded.uri, mime_type=mime_type)
+    except Exception as e:
+        # Fall back to inlining the bytes if the Files API is unavailable
+        print(f"File upload failed, sending inline: {e}")
+        with open(path, "rb") as f:
+            return types.Part.from_bytes(data=f.read(), mime_type=mime_type)
+
+# Helper: Gemini Response Cache
+def hash_file(path: str) -> str:
+    """Return the SHA-256 hex digest of a file's contents."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def gemini_cache_key(template_id: str, system_instruction: str, interim_data: str = None, text_input: str = None, file_hashes: list = []) -> str:
+    """Build an exact-match cache key from everything that is sent to Gemini."""
+    h = hashlib.sha256()
+    for part in (GEMINI_MODEL, template_id, system_instruction, interim_data or "", text_input or ""):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    for file_hash in sorted(file_hashes):
+        h.update(file_hash.encode("ascii"))
+    return h.hexdigest()
+
+_last_cache_sweep = 0.0
+
+def sweep_gemini_cache(force: bool = False):
+    """Delete expired response cache entries and upload records (at most once per sweep interval)."""
+    global _last_cache_sweep
+    now = time.time()
+    if not force and now - _last_cache_sweep < GEMINI_CACHE_SWEEP_INTERVAL:
+        return
+    _last_cache_sweep = now
+    purge_old_files(GEMINI_CACHE_DIR, GEMINI_CACHE_TTL)
+    purge_old_files(GEMINI_FILES_DIR, GEMINI_FILES_TTL)
+    purge_old_files(CONTEXT_CACHE_DIR, GEMINI_CONTEXT_CACHE_TTL)
+
+def load_cached_response(key: str) -> Optional[Dict[str, str]]:
+    """Return a cached Gemini mapping, or None if missing or expired."""
+    cache_path = os.path.join(GEMINI_CACHE_DIR, f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(cache_path) > GEMINI_CACHE_TTL:
+            os.remove(cache_path)
+            return None
+        with open(cache_path, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error reading Gemini cache {cache_path}: {e}")
+        return None
+
+def save_cached_response(key: str, mapping: Dict[str, str]):
+    """Store a Gemini mapping in the response cache."""
+    cache_path = os.path.join(GEMINI_CACHE_DIR, f"{key}.json")
+    try:
+        write_json_atomic(cache_path, mapping)
+    except Exception as e:
+        print(f"Error writing Gemini cache {cache_path}: {e}")
+    sweep_gemini_cache()
+
+# Cached Gemini output contains personal data; don't keep it past its TTL
+sweep_gemini_cache(force=True)
+
+# Helper: Gemini Processing
+async def call_gemini(template_id: str, template_info: dict, text_input: str = None, file_paths: list = [], interim_data: str = None, file_hashes: Dict[str, str] = None, use_cache: bool = True) -> tuple[Dict[str, str], bool]:
+    """
+    Call Gemini to map input data to Excel structure.
+    interim_data: Optional string containing interim monitoring data for final evaluation mode.
+    file_hashes: Optional {path: sha256} computed while saving; missing entries are hashed here.
+    use_cache: False skips the response cache lookup (the fresh result still replaces the cached one).
+    Returns (mapping, cache_hit); identical inputs are served from the response cache.
+    """
+    if not client:
+        raise HTTPException(status_code=500, detail="Gemini Client not initialized.")
+
+    system_instruction = build_system_instruction(template_info)
     
-    contents = [system_instruction]
+    # Hash each upload once (in parallel threads); used for both the response cache and upload dedup
+    file_hashes = dict(file_hashes or {})
+    missing = [path for path in file_paths if path not in file_hashes]
+    hashes = await asyncio.gather(*[asyncio.to_thread(hash_file, path) for path in missing])
+    file_hashes.update(zip(missing, hashes))
+    cache_key = gemini_cache_key(template_id, system_instruction, interim_data=interim_data, text_input=text_input, file_hashes=list(file_hashes.values()))
+    cached_mapping = await asyncio.to_thread(load_cached_response, cache_key) if use_cache else None
+    if isinstance(cached_mapping, dict):
+        print(f"Gemini cache hit: {cache_key}")
+        return cached_mapping, True
+
+    # Static instruction is served from the context cache when available
+    cache_name = await asyncio.to_thread(get_context_cache, template_id, system_instruction)
+    contents = [] if cache_name else [system_instruction]
     
     # Add interim monitoring data if provided (for final evaluation mode)
     if interim_data:
@@ -265,43 +737,36 @@ def call_gemini(template_info: dict, text_input: str = None, file_paths: list =
     if text_input:
         contents.append(f"--- Input Data (Text) ---\n{text_input}\n")
     
-    for path in file_paths:
-        mime_type = "application/octet-stream" # Default
-        if path.lower().endswith(".mp3"): mime_type = "audio/mp3"
-        elif path.lower().endswith(".wav"): mime_type = "audio/wav"
-        elif path.lower().endswith(".m4a"): mime_type = "audio/mp4"
-        elif path.lower().endswith(".aac"): mime_type = "audio/aac"
-        elif path.lower().endswith(".flac"): mime_type = "audio/flac"
-        elif path.lower().endswith(".ogg"): mime_type = "audio/ogg"
-        elif path.lower().endswith(".wma"): mime_type = "audio/x-ms-wma"
-        elif path.lower().endswith(".jobt"): mime_type = "image/jpeg" 
-        elif path.lower().endswith(".jpg") or path.lower().endswith(".jpeg"): mime_type = "image/jpeg"
-        elif path.lower().endswith(".png"): mime_type = "image/png"
-        elif path.lower().endswith(".webp"): mime_type = "image/webp"
-        elif path.lower().endswith(".heic") or path.lower().endswith(".heif"): mime_type = "image/heic"
-        elif path.lower().endswith(".mp4"): mime_type = "video/mp4"
-        elif path.lower().endswith(".mov"): mime_type = "video/quicktime"
-        elif path.lower().endswith(".webm"): mime_type = "video/webm"
-        elif path.lower().endswith(".pdf"): mime_type = "application/pdf"
-        elif path.lower().endswith(".txt"): mime_type = "text/plain"
-        elif path.lower().endswith(".csv"): mime_type = "text/csv"
-
-        # Read file bytes for new SDK upload
-        print(f"Reading file: {path}")
-        with open(path, "rb") as f:
-            file_data = f.read()
-            
-        part = types.Part.from_bytes(data=file_data, mime_type=mime_type)
-        contents.append(part)
+    # Upload all files concurrently; gather keeps the original order
+    parts = await asyncio.gather(*[asyncio.to_thread(build_file_part, path, file_hashes[path]) for path in file_paths])
+    contents.extend(parts)
         
     contents.append("\nExtract the information and map it to the JSON structure.")
 
     print("Sending request to Gemini (v3 Flash Preview)...")
     try:
-        response = client.models.generate_content(
-            model="gemini-3-flash-preview",
-            contents=contents
-        )
+        if cache_name:
+            try:
+                response = await client.aio.models.generate_content(
+                    model=GEMINI_MODEL,
+                    contents=contents,
+                    config=types.GenerateContentConfig(cached_content=cache_name)
+                )
+            except Exception as e:
+                if not is_context_cache_error(e):
+                    raise
+                # Cache expired or was deleted; retry once with the inline instruction
+                print(f"Gemini cached request failed, retrying without cache: {e}")
+                await asyncio.to_thread(invalidate_context_cache, template_id, cache_name)
+                response = await client.aio.models.generate_content(
+                    model=GEMINI_MODEL,
+                    contents=[system_instruction] + contents
+                )
+        else:
+            response = await client.aio.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=contents
+            )
     except Exception as e:
         print(f"Gemini API Error: {e}")
         raise HTTPException(status_code=500, detail=f"Gemini API Error: {str(e)}")
@@ -314,16 +779,23 @@ def call_gemini(template_info: dict, text_input: str = None, file_paths: list =
         if cleaned_text.endswith("```"):
             cleaned_text = cleaned_text[:-3]
         
-        # DEBUG: Save response to file
-        with open("debug_last_response.json", "w", encoding="utf-8") as f:
-            f.write(cleaned_text)
+        # DEBUG: Save response to file (opt-in via DEBUG_GEMINI)
+        if DEBUG_GEMINI:
+            with open("debug_last_response.json", "w", encoding="utf-8") as f:
+                f.write(cleaned_text)
             
-        mapping = json.loads(cleaned_text)
-        return mapping
+        mapping = orjson.loads(cleaned_text)
+        # Only a JSON object can be mapped to cells; don't cache (or use) anything else
+        if not isinstance(mapping, dict):
+            raise ValueError(f"Expected a JSON object, got {type(mapping).__name__}")
     except Exception as e:
         print(f"Error parsing Gemini response: {response.text}")
         raise HTTPException(status_code=500, detail="Failed to interpret AI response.")
 
+    # Also runs the periodic cache sweep (scandir), so keep it off the event loop
+    await asyncio.to_thread(save_cached_response, cache_key, mapping)
+    return mapping, False
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request, username: str = Depends(get_current_username)):
     return templates.TemplateResponse("index.html", {"request": request})
@@ -331,11 +803,12 @@ async def read_root(request: Request, username: str = Depends(get_current_userna
 @app.get("/templates")
 async def get_templates(username: str = Depends(get_current_username)):
     """Return available templates."""
-    return TEMPLATE_CONFIG
+    return Response(content=TEMPLATES_JSON, media_type="application/json")
 
 @app.post("/process")
 async def process_data(
     background_tasks: BackgroundTasks,
+    response: Response,
     template_id: str = Form(...),
     text_input: str = Form(None),
     user_name: str = Form(None),
@@ -352,6 +825,7 @@ async def process_data(
     cm_service_manager: str = Form(None),
     support_period: str = Form(None),
     kobetsu_service_manager: str = Form(None),
+    refresh: bool = Form(False),
     files: list[UploadFile] = File(None),
     username: str = Depends(get_current_username)
 ):
@@ -390,34 +864,28 @@ async def process_data(
     # Combine with text_input
     full_text_input = (text_input or "") + manual_info_text
     
-    # 1. Load Excel Template
-    # Template files are expected to be in 'welfare_record_app/template/' 
-    # but the config says "template/filename.xlsx", so it depends on CWD.
-    # Assuming CWD is 'welfare_record_app'.
-    template_source_path = selected_template['filename']
-    if not os.path.exists(template_source_path):
-         # Try prepending 'template/' or checking relative path
-         # Just incase config just has filename
-         alt_path = os.path.join("template", os.path.basename(selected_template['filename']))
-         if os.path.exists(alt_path):
-             template_source_path = alt_path
-         else:
-             raise HTTPException(status_code=500, detail=f"Template file not found: {template_source_path}")
+    # 1. Check Excel Template (loaded into TEMPLATE_BYTES at startup)
+    if template_id not in TEMPLATE_BYTES:
+        raise HTTPException(status_code=500, detail=f"Template file not found: {selected_template['filename']}")
 
     # 2. Handle Input Data & Call Gemini
     file_paths = []
+    file_hashes = {}
     
     try:
         # Save uploaded files
         if files:
+            uploads = []
             for file in files:
                 # Skip empty filenames
                 if not file.filename: continue
                 
-                file_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}_{file.filename}")
-                with open(file_path, "wb") as f:
-                    shutil.copyfileobj(file.file, f)
+                file_path = os.path.join(TEMP_DIR, f"{secrets.token_hex(8)}_{file.filename}")
+                uploads.append((file, file_path))
                 file_paths.append(file_path)
+            # Write all uploads concurrently off the event loop
+            hashes = await asyncio.gather(*[asyncio.to_thread(save_upload, file, file_path) for file, file_path in uploads])
+            file_hashes = {file_path: file_hash for (_, file_path), file_hash in zip(uploads, hashes)}
         
         if not full_text_input and not file_paths:
              raise HTTPException(status_code=400, detail="No input provided (files or text).")
@@ -428,11 +896,12 @@ async def process_data(
             for fp in file_paths:
                 # Check if it's an Excel file
                 if fp.endswith('.xlsx') or fp.endswith('.xls'):
-                    interim_data = read_excel_monitoring_data(fp)
+                    interim_data = await asyncio.to_thread(read_excel_monitoring_data, fp)
                     if interim_data:
                         break  # Use first Excel file found
         
-        mapping = call_gemini(selected_template, text_input=full_text_input, file_paths=file_paths, interim_data=interim_data)
+        mapping, cache_hit = await call_gemini(template_id, selected_template, text_input=full_text_input, file_paths=file_paths, interim_data=interim_data, file_hashes=file_hashes, use_cache=not refresh)
+        response.headers["X-Cache"] = "HIT" if cache_hit else "MISS"
         
         # --- PRIORITY OVERRIDE START ---
         # Overwrite AI results with Manual Inputs if provided
@@ -458,11 +927,12 @@ async def process_data(
                 mapping["記入日"] = date.replace("-", "/") # Simple format
                 
                 dt = datetime.datetime.strptime(date, '%Y-%m-%d')
+                month, day = str(dt.month), str(dt.day)
                 mapping["作成年_西暦"] = f"{dt.year}年"
-                mapping["作成月"] = f"{dt.month}月"
-                mapping["作成日"] = f"{dt.day}日"
-                mapping["月"] = f"{dt.month}"
-                mapping["日"] = f"{dt.day}"
+                mapping["作成月"] = f"{month}月"
+                mapping["作成日"] = f"{day}日"
+                mapping["月"] = month
+                mapping["日"] = day
                 mapping["和暦の数字のみ"] = str(dt.year - 2018) # R1=2019
             except ValueError:
                 pass
@@ -541,7 +1011,8 @@ async def process_data(
              user_name_val = mapping["氏名のふりがな"]
 
         # Date string
-        date_str = datetime.datetime.now().strftime("%y.%m.%d")
+        today = datetime.date.today()
+        date_str = f"{today.year % 100:02d}.{today.month:02d}.{today.day:02d}"
         template_name = selected_template['name']
         
         # Construct Filename: YY.MM.DD_TemplateName【UserName】.xlsx
@@ -549,26 +1020,55 @@ async def process_data(
         safe_user_name = "".join([c for c in user_name_val if c.isalnum() or c in (' ', '　', '_', '-')])
         custom_filename = f"{date_str}_{template_name}【{safe_user_name}】.xlsx"
         
-        output_filename = fill_excel(template_source_path, mapping, selected_template['mapping'], output_name=custom_filename)
+        # openpyxl load/save is CPU-bound; keep it off the event loop
+        output_filename = await asyncio.to_thread(fill_excel, template_id, mapping, output_name=custom_filename)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Excel generation failed: {str(e)}")
 
     # Cleanup input files in background
     background_tasks.add_task(cleanup_files, file_paths)
+    # Remove outputs older than the retention window
+    background_tasks.add_task(purge_old_files, OUTPUT_DIR, OUTPUT_RETENTION_SECONDS)
 
     return {"filename": output_filename}
 
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header (list, W/ prefix or '*') against an ETag."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
 @app.get("/download/{filename}")
-async def download_file(filename: str, background_tasks: BackgroundTasks, username: str = Depends(get_current_username)):
+async def download_file(filename: str, request: Request, username: str = Depends(get_current_username)):
     file_path = os.path.join(OUTPUT_DIR, filename)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
     
-    # Schedule cleanup of output file after response
-    background_tasks.add_task(cleanup_files, [file_path])
+    # Outputs are removed by age (see purge_old_files), not per download: filenames are
+    # reused when the same record is regenerated, and timers would be lost on worker restart
+    stat_result = os.stat(file_path)
+    if time.time() - stat_result.st_mtime > OUTPUT_RETENTION_SECONDS:
+        cleanup_files([file_path])
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    # Other expired outputs go too (also swept periodically by the lifespan task)
+    await asyncio.to_thread(purge_old_files, OUTPUT_DIR, OUTPUT_RETENTION_SECONDS)
+    
+    # no-cache: the URL is reused on regeneration, so always revalidate against the ETag
+    headers = {
+        "Cache-Control": "private, no-cache",
+        "ETag": f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"',
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
     
-    return FileResponse(file_path, filename=filename, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    # FileResponse streams via sendfile where available and handles Range/If-Range
+    return FileResponse(file_path, filename=filename, headers=headers, stat_result=stat_result, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))